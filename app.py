@@ -12,20 +12,36 @@
 # - CSV export, cleaning, transform, analysis
 
 import streamlit as st
-from bson.objectid import ObjectId
+from pymongo import MongoClient, InsertOne
+from pymongo.cursor import CursorType
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from bson.regex import Regex
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
 from datetime import datetime
 import os
-import io
-import matplotlib.pyplot as plt
+import re
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 
 st.set_page_config(page_title="Inventory Management", layout="wide")
 st.title("Inventory Management System — Streamlit + MongoDB")
 
 # ---------- MongoDB connection helper ----------
-@st.experimental_singleton
+@st.cache_resource
 def get_client(uri: str):
-    client = MongoClient(uri)
+    # Created (and pinged) once per process; reruns reuse the pooled client.
+    client = MongoClient(
+        uri,
+        maxPoolSize=20,
+        minPoolSize=1,
+        serverSelectionTimeoutMS=3000,
+        compressors="zstd",
+        retryWrites=True,
+    )
     try:
         client.admin.command("ping")
     except ConnectionFailure as e:
@@ -57,96 +73,310 @@ st.sidebar.markdown("---")
 action = st.sidebar.selectbox("Choose action", ["View inventory", "Add product", "Update product", "Delete product", "Seed sample data"]) 
 
 # ---------- Sample data (20 items) ----------
+# last_restock is a datetime so Mongo stores a native BSON date.
 SAMPLE_PRODUCTS = [
-    {"sku": "SKU1001", "name": "Classic T-Shirt", "category": "Apparel", "quantity": 120, "price": 399.0, "supplier": "Textile Co", "last_restock": "2025-10-01"},
-    {"sku": "SKU1002", "name": "Slim Jeans", "category": "Apparel", "quantity": 45, "price": 1299.0, "supplier": "Denim Inc", "last_restock": "2025-09-15"},
-    {"sku": "SKU1003", "name": "Running Shoes", "category": "Footwear", "quantity": 60, "price": 2199.0, "supplier": "RunFast", "last_restock": "2025-10-20"},
-    {"sku": "SKU1004", "name": "Formal Shoes", "category": "Footwear", "quantity": 25, "price": 2499.0, "supplier": "LeatherWorks", "last_restock": "2025-08-30"},
-    {"sku": "SKU1005", "name": "Baseball Cap", "category": "Accessories", "quantity": 200, "price": 199.0, "supplier": "CapMakers", "last_restock": "2025-11-01"},
-    {"sku": "SKU1006", "name": "Wrist Watch", "category": "Accessories", "quantity": 30, "price": 3499.0, "supplier": "TimeKeep", "last_restock": "2025-07-10"},
-    {"sku": "SKU1007", "name": "Leather Belt", "category": "Accessories", "quantity": 80, "price": 499.0, "supplier": "BeltCo", "last_restock": "2025-10-05"},
-    {"sku": "SKU1008", "name": "Hoodie", "category": "Apparel", "quantity": 70, "price": 999.0, "supplier": "WarmWear", "last_restock": "2025-09-25"},
-    {"sku": "SKU1009", "name": "Socks (Pack of 3)", "category": "Apparel", "quantity": 300, "price": 249.0, "supplier": "SockHouse", "last_restock": "2025-10-11"},
-    {"sku": "SKU1010", "name": "Backpack", "category": "Bags", "quantity": 40, "price": 1599.0, "supplier": "BagWorld", "last_restock": "2025-09-01"},
-    {"sku": "SKU1011", "name": "Laptop Sleeve", "category": "Bags", "quantity": 75, "price": 699.0, "supplier": "CaseWorks", "last_restock": "2025-08-20"},
-    {"sku": "SKU1012", "name": "Water Bottle", "category": "Home", "quantity": 150, "price": 299.0, "supplier": "HydroLtd", "last_restock": "2025-10-18"},
-    {"sku": "SKU1013", "name": "Wireless Earbuds", "category": "Electronics", "quantity": 55, "price": 3299.0, "supplier": "SoundTech", "last_restock": "2025-11-02"},
-    {"sku": "SKU1014", "name": "Phone Charger", "category": "Electronics", "quantity": 180, "price": 399.0, "supplier": "ChargeIt", "last_restock": "2025-10-28"},
-    {"sku": "SKU1015", "name": "Notebook A4", "category": "Stationery", "quantity": 500, "price": 49.0, "supplier": "PaperGoods", "last_restock": "2025-09-10"},
-    {"sku": "SKU1016", "name": "Ballpoint Pen", "category": "Stationery", "quantity": 1000, "price": 19.0, "supplier": "WriteWell", "last_restock": "2025-11-03"},
-    {"sku": "SKU1017", "name": "Desk Lamp", "category": "Home", "quantity": 35, "price": 899.0, "supplier": "BrightHome", "last_restock": "2025-08-27"},
-    {"sku": "SKU1018", "name": "Coffee Mug", "category": "Home", "quantity": 220, "price": 249.0, "supplier": "CeramicArt", "last_restock": "2025-10-30"},
-    {"sku": "SKU1019", "name": "USB Flash Drive 32GB", "category": "Electronics", "quantity": 95, "price": 599.0, "supplier": "StoragePlus", "last_restock": "2025-09-05"},
-    {"sku": "SKU1020", "name": "Travel Adapter", "category": "Electronics", "quantity": 60, "price": 349.0, "supplier": "GlobeTech", "last_restock": "2025-10-12"},
+    {"sku": "SKU1001", "name": "Classic T-Shirt", "category": "Apparel", "quantity": 120, "price": 399.0, "supplier": "Textile Co", "last_restock": datetime(2025, 10, 1)},
+    {"sku": "SKU1002", "name": "Slim Jeans", "category": "Apparel", "quantity": 45, "price": 1299.0, "supplier": "Denim Inc", "last_restock": datetime(2025, 9, 15)},
+    {"sku": "SKU1003", "name": "Running Shoes", "category": "Footwear", "quantity": 60, "price": 2199.0, "supplier": "RunFast", "last_restock": datetime(2025, 10, 20)},
+    {"sku": "SKU1004", "name": "Formal Shoes", "category": "Footwear", "quantity": 25, "price": 2499.0, "supplier": "LeatherWorks", "last_restock": datetime(2025, 8, 30)},
+    {"sku": "SKU1005", "name": "Baseball Cap", "category": "Accessories", "quantity": 200, "price": 199.0, "supplier": "CapMakers", "last_restock": datetime(2025, 11, 1)},
+    {"sku": "SKU1006", "name": "Wrist Watch", "category": "Accessories", "quantity": 30, "price": 3499.0, "supplier": "TimeKeep", "last_restock": datetime(2025, 7, 10)},
+    {"sku": "SKU1007", "name": "Leather Belt", "category": "Accessories", "quantity": 80, "price": 499.0, "supplier": "BeltCo", "last_restock": datetime(2025, 10, 5)},
+    {"sku": "SKU1008", "name": "Hoodie", "category": "Apparel", "quantity": 70, "price": 999.0, "supplier": "WarmWear", "last_restock": datetime(2025, 9, 25)},
+    {"sku": "SKU1009", "name": "Socks (Pack of 3)", "category": "Apparel", "quantity": 300, "price": 249.0, "supplier": "SockHouse", "last_restock": datetime(2025, 10, 11)},
+    {"sku": "SKU1010", "name": "Backpack", "category": "Bags", "quantity": 40, "price": 1599.0, "supplier": "BagWorld", "last_restock": datetime(2025, 9, 1)},
+    {"sku": "SKU1011", "name": "Laptop Sleeve", "category": "Bags", "quantity": 75, "price": 699.0, "supplier": "CaseWorks", "last_restock": datetime(2025, 8, 20)},
+    {"sku": "SKU1012", "name": "Water Bottle", "category": "Home", "quantity": 150, "price": 299.0, "supplier": "HydroLtd", "last_restock": datetime(2025, 10, 18)},
+    {"sku": "SKU1013", "name": "Wireless Earbuds", "category": "Electronics", "quantity": 55, "price": 3299.0, "supplier": "SoundTech", "last_restock": datetime(2025, 11, 2)},
+    {"sku": "SKU1014", "name": "Phone Charger", "category": "Electronics", "quantity": 180, "price": 399.0, "supplier": "ChargeIt", "last_restock": datetime(2025, 10, 28)},
+    {"sku": "SKU1015", "name": "Notebook A4", "category": "Stationery", "quantity": 500, "price": 49.0, "supplier": "PaperGoods", "last_restock": datetime(2025, 9, 10)},
+    {"sku": "SKU1016", "name": "Ballpoint Pen", "category": "Stationery", "quantity": 1000, "price": 19.0, "supplier": "WriteWell", "last_restock": datetime(2025, 11, 3)},
+    {"sku": "SKU1017", "name": "Desk Lamp", "category": "Home", "quantity": 35, "price": 899.0, "supplier": "BrightHome", "last_restock": datetime(2025, 8, 27)},
+    {"sku": "SKU1018", "name": "Coffee Mug", "category": "Home", "quantity": 220, "price": 249.0, "supplier": "CeramicArt", "last_restock": datetime(2025, 10, 30)},
+    {"sku": "SKU1019", "name": "USB Flash Drive 32GB", "category": "Electronics", "quantity": 95, "price": 599.0, "supplier": "StoragePlus", "last_restock": datetime(2025, 9, 5)},
+    {"sku": "SKU1020", "name": "Travel Adapter", "category": "Electronics", "quantity": 60, "price": 349.0, "supplier": "GlobeTech", "last_restock": datetime(2025, 10, 12)},
 ]
 
 # ---------- Utilities ----------
-def fetch_products(filter_q=None, limit=1000):
+# Fields rendered by the UI; `_id` is always returned by Mongo unless excluded.
+_PROJ = {"sku": 1, "name": 1, "category": 1, "quantity": 1, "price": 1, "supplier": 1, "last_restock": 1}
+
+def fetch_products(filter_q=None, limit=1000, projection=None):
     q = filter_q or {}
-    docs = list(coll.find(q).limit(limit))
+    docs = list(coll.find(q, projection).limit(limit))
     for d in docs:
         d['id'] = str(d['_id'])
         d.pop('_id', None)
     return docs
 
+def build_search_query(search, text_search=False):
+    """Build the Mongo filter used by the inventory search box.
+
+    With the search indexes in place, plain words use the text index plus an
+    anchored prefix on the indexed name/sku/category fields; otherwise (or for
+    anything with regex syntax) the search is matched as a case-insensitive pattern."""
+    if not search:
+        return {}
+    if text_search and re.fullmatch(r"[\w\- ]+", search):
+        prefix = Regex("^" + re.escape(search), "i")
+        # Every clause is indexed (text + B-tree), so $text under $or stays plannable.
+        return {"$or": [{"$text": {"$search": search}}] + [{f: prefix} for f in ("name", "sku", "category")]}
+    pat = Regex(search, "i")
+    return {"$or": [{f: pat} for f in ("name", "sku", "category")]}
+
+@st.cache_resource
+def _write_versions():
+    # Process-wide, like the st.cache_data entries keyed on it: a per-session
+    # counter would let one session's cached result stand in for another's write.
+    return {"counter": itertools.count(1), "by_coll": {}}
+
+def coll_version(db_name, coll_name):
+    """Version of a collection's contents, bumped by every write made through this app."""
+    return _write_versions()["by_coll"].get((db_name, coll_name), 0)
+
+def bump_coll_version(db_name, coll_name):
+    """Invalidate cached reads of a collection after writing to it."""
+    versions = _write_versions()
+    versions["by_coll"][(db_name, coll_name)] = next(versions["counter"])
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _ensure_indexes(db_name, coll_name, version):
+    """Create the search indexes on an existing collection.
+
+    Returns (text_search, error): whether $text queries can be used, and the
+    failure message if index creation failed. Keyed on `version` and rechecked
+    after ttl, so a dropped and re-created collection gets its indexes back."""
+    c = client[db_name][coll_name]
+    try:
+        if not c.index_information():
+            # No such collection; don't create it just because its name was typed in the sidebar.
+            return False, None
+        c.create_index([("sku", 1)], unique=False)
+        c.create_index([("name", 1)])
+        c.create_index([("category", 1)])
+        c.create_index([("quantity", 1)])
+        c.create_index([("name", "text"), ("sku", "text"), ("category", "text")])
+    except Exception as e:
+        return False, str(e)
+    return True, None
+
+# Server-side equivalent of clean_and_transform's type coercion.
+_NORMALIZE = {"$set": {
+    "quantity": {"$convert": {"input": "$quantity", "to": "long", "onError": 0, "onNull": 0}},
+    "price": {"$convert": {"input": "$price", "to": "double", "onError": 0.0, "onNull": 0.0}},
+    "last_restock": {"$convert": {"input": "$last_restock", "to": "date", "onError": None, "onNull": None}},
+}}
+
+# Fixed column order for the low-stock table (missing fields become nulls).
+_LOW_STOCK_SCHEMA = pa.schema([
+    ("sku", pa.string()), ("name", pa.string()), ("quantity", pa.int64()),
+    ("supplier", pa.string()), ("days_since_restock", pa.int64()),
+])
+
+def inventory_pipelines(q, low_stock_thresh):
+    """Aggregation pipelines behind the View inventory charts (needs MongoDB 5.0+)."""
+    value = {"$multiply": ["$quantity", "$price"]}
+    return {
+        "category": [
+            {"$match": q}, _NORMALIZE,
+            {"$match": {"category": {"$ne": None}}},
+            {"$group": {"_id": "$category", "total_qty": {"$sum": "$quantity"}, "total_value": {"$sum": value}}},
+            {"$sort": {"_id": 1}},
+            {"$project": {"_id": 0, "category": "$_id", "total_qty": 1, "total_value": 1}},
+        ],
+        "top_value": [
+            {"$match": q}, _NORMALIZE,
+            {"$project": {"_id": 0, "name": {"$ifNull": ["$name", "Unknown"]}, "value": value}},
+            {"$sort": {"value": -1}},
+            {"$limit": 10},
+        ],
+        "restock_monthly": [
+            {"$match": q}, _NORMALIZE,
+            {"$match": {"last_restock": {"$ne": None}}},
+            {"$group": {"_id": {"$dateTrunc": {"date": "$last_restock", "unit": "month"}}, "total_qty": {"$sum": "$quantity"}}},
+            {"$sort": {"_id": 1}},
+            {"$project": {"_id": 0, "restock_month": "$_id", "total_qty": 1}},
+        ],
+        "low_stock": [
+            {"$match": q}, _NORMALIZE,
+            # after _NORMALIZE so string/missing quantities count as 0, as in the pandas version
+            {"$match": {"quantity": {"$lte": low_stock_thresh}}},
+            {"$sort": {"quantity": 1}},
+            {"$limit": 20},
+            {"$project": {
+                "_id": 0, "sku": 1, "quantity": 1, "supplier": 1,
+                "name": {"$ifNull": ["$name", "Unknown"]},
+                "days_since_restock": {"$ifNull": [
+                    {"$dateDiff": {"startDate": "$last_restock", "endDate": "$$NOW", "unit": "day"}}, -1]},
+            }},
+        ],
+    }
+
+@st.cache_resource
+def _query_pool():
+    # One pool per process; the script body reruns, so it can't live at module scope.
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="mongo-agg")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_aggregates(db_name, coll_name, search, text_search, low_stock_thresh, version):
+    """Cached chart aggregates; same invalidation scheme as _fetch_raw.
+    The pipelines are independent, so they run concurrently on the pooled client."""
+    c = client[db_name][coll_name]
+    pipelines = inventory_pipelines(build_search_query(search, text_search), low_stock_thresh)
+    futs = {name: _query_pool().submit(lambda p=pipe: list(c.aggregate(p))) for name, pipe in pipelines.items()}
+    return {name: f.result() for name, f in futs.items()}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_raw(db_name, coll_name, search, text_search, version, limit=2000):
+    """Cached inventory read. `version` is only part of the cache key: it changes
+    after every write made through this app, and ttl covers writes made elsewhere."""
+    q = build_search_query(search, text_search)
+    return list(client[db_name][coll_name].find(q, _PROJ).limit(limit))
+
+def _batches(cursor, n=1000):
+    """Yield lists of up to n documents from a cursor without materialising it."""
+    batch = []
+    for d in cursor:
+        batch.append(d)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Column types for projected inventory docs (the _PROJ fields plus the string id).
+RAW_SCHEMA = pa.schema([
+    ("sku", pa.string()), ("name", pa.string()), ("category", pa.string()),
+    ("quantity", pa.int64()), ("price", pa.float64()), ("supplier", pa.string()),
+    ("last_restock", pa.timestamp("ms")), ("id", pa.string()),
+])
+
+def _doc_columns(docs, keys):
+    """Read docs into one pre-allocated list per key; `_id` becomes a string `id` column
+    (docs that already carry `id` instead, like fetch_products output, keep it).
+    The docs themselves are never copied or mutated."""
+    n = len(docs)
+    ids = [None] * n
+    cols = {k: [None] * n for k in keys}
+    for i, d in enumerate(docs):
+        _id = d.get('_id')
+        ids[i] = d.get('id') if _id is None else str(_id)
+        for k in keys:
+            cols[k][i] = d.get(k)
+    cols['id'] = ids
+    return cols
+
+def _typed_array(values, typ):
+    """Build an Arrow array, coercing stray types (e.g. '12' or 10.0) like pandas used to.
+    NaN becomes null (from_pandas) so it is filled like a missing value."""
+    try:
+        return pa.array(values, typ, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if pa.types.is_string(typ):
+            return pa.array([None if v is None else str(v) for v in values], typ)
+        s = pd.Series(values, dtype=object)
+        s = pd.to_datetime(s, errors='coerce') if pa.types.is_timestamp(typ) else pd.to_numeric(s, errors='coerce')
+        return pa.Array.from_pandas(s).cast(typ, safe=False)
+
+def docs_to_arrow(docs, projection_keys, schema):
+    """Build an Arrow table from Mongo docs column-wise, typed by `schema`."""
+    cols = _doc_columns(docs, projection_keys)
+    return pa.table({f.name: _typed_array(cols[f.name], f.type) for f in schema})
+
 def docs_to_dataframe(docs, drop_fields=None):
     """Convert Mongo docs to DataFrame and sanitize."""
     if drop_fields is None:
         drop_fields = []
     if not docs:
         return pd.DataFrame()
-    clean_docs = []
-    for d in docs:
-        doc = d.copy()
-        if '_id' in doc:
-            doc['id'] = str(doc['_id'])
-            doc.pop('_id', None)
-        for f in drop_fields:
-            if f in doc:
-                doc.pop(f, None)
-        clean_docs.append(doc)
-    df = pd.DataFrame(clean_docs)
-    if 'id' in df.columns:
-        cols = ['id'] + [c for c in df.columns if c != 'id']
-        df = df[cols]
-    return df
+    keys = list(dict.fromkeys(k for d in docs for k in d if k not in ('_id', 'id') and k not in drop_fields))
+    return pd.DataFrame(_doc_columns(docs, keys), columns=['id'] + keys)
+
+# RAW_SCHEMA plus the columns derived by clean_and_transform.
+CLEAN_SCHEMA = RAW_SCHEMA.append(pa.field("value", pa.float64())).append(pa.field("days_since_restock", pa.int64()))
+
+def raw_docs_to_table(docs):
+    """Convert raw mongo docs list to an Arrow table with fixed column types."""
+    return docs_to_arrow(docs, list(_PROJ), RAW_SCHEMA)
+
+def clean_and_transform(table):
+    """Fill gaps and add useful columns with pyarrow.compute (types are already fixed by raw_docs_to_table)."""
+    if table.num_rows == 0:
+        return CLEAN_SCHEMA.empty_table()
+    for name, default in (('quantity', 0), ('price', 0.0), ('name', 'Unknown'), ('sku', '')):
+        i = table.schema.get_field_index(name)
+        table = table.set_column(i, name, pc.fill_null(table[name], default))
+
+    value = pc.multiply(table['quantity'], table['price'])
+    today = pa.scalar(datetime.combine(datetime.today().date(), datetime.min.time()), type=pa.timestamp("ms"))
+    days = pc.fill_null(pc.days_between(table['last_restock'], today), -1)
+    return table.append_column("value", value).append_column("days_since_restock", days)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cleaned_inventory(db_name, coll_name, search, text_search, version):
+    """Cleaned View inventory as an Arrow table, reused across reruns until the next write.
+    Kept in Arrow so st.dataframe and the CSV writer can take it without another conversion."""
+    return clean_and_transform(raw_docs_to_table(_fetch_raw(db_name, coll_name, search, text_search, version)))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _price_histogram(db_name, coll_name, search, text_search, version, bins=10):
+    """Price distribution counts indexed by each bin's lower edge."""
+    table = _cleaned_inventory(db_name, coll_name, search, text_search, version)
+    vals = pc.drop_null(table['price']).to_numpy()
+    counts, edges = np.histogram(vals[np.isfinite(vals)], bins=bins)
+    # Numeric bin starts stay distinct even when the price range is narrower than any label precision.
+    return pd.Series(counts, index=pd.Index(edges[:-1], name='price_from'))
 
 def dataframe_to_csv_bytes(df, include_bom=True):
     """Return CSV as bytes for Streamlit download_button (UTF-8)."""
     if df.empty:
         return "".encode('utf-8')
-    csv_str = df.to_csv(index=False)
-    csv_bytes = csv_str.encode('utf-8-sig') if include_bom else csv_str.encode('utf-8')
-    return csv_bytes
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed-type object columns (e.g. dates stored as both strings and datetimes) can't be Arrow.
+        csv_str = df.to_csv(index=False)
+        return csv_str.encode('utf-8-sig') if include_bom else csv_str.encode('utf-8')
+    sink = pa.BufferOutputStream()
+    pacsv.write_csv(table, sink)
+    csv_bytes = sink.getvalue().to_pybytes()
+    return b"\xef\xbb\xbf" + csv_bytes if include_bom else csv_bytes
 
 def save_csv_to_server(df, path):
     """Save DataFrame to server disk. Returns True on success."""
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    df.to_csv(path, index=False, encoding='utf-8')
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df.to_csv(path, index=False, encoding='utf-8')
+    else:
+        pacsv.write_csv(table, path)
     return os.path.exists(path)
 
+text_search, index_error = _ensure_indexes(DB_NAME, COLL_NAME, coll_version(DB_NAME, COLL_NAME))
+if index_error:
+    st.sidebar.warning(f"Could not create indexes: {index_error}")
+
 # ---------- Actions ----------
 if action == "Seed sample data":
     st.header("Seed 20 sample products into the collection")
     st.write("This will insert 20 predefined sample products if the collection is empty or if you choose to force insert.")
     force = st.checkbox("Force insert even if collection not empty")
     if st.button("Seed sample data"):
-        existing = coll.count_documents({})
+        existing = coll.estimated_document_count()  # metadata read; only used as an emptiness gate
         if existing > 0 and not force:
             st.warning(f"Collection already has {existing} documents. Check 'Force insert' to insert anyway.")
         else:
-            to_insert = []
-            for p in SAMPLE_PRODUCTS:
-                copy = p.copy()
-                copy['quantity'] = int(copy['quantity'])
-                copy['price'] = float(copy['price'])
-                try:
-                    copy['last_restock'] = datetime.fromisoformat(copy['last_restock']).date().isoformat()
-                except:
-                    pass
-                to_insert.append(copy)
-            res = coll.insert_many(to_insert)
-            st.success(f"Inserted {len(res.inserted_ids)} products.")
+            ops = [InsertOne(dict(p)) for p in SAMPLE_PRODUCTS]
+            try:
+                res = coll.bulk_write(ops, ordered=False)
+                st.success(f"Inserted {res.inserted_count} products.")
+            except BulkWriteError as e:
+                details = e.details
+                st.warning(f"Inserted {details.get('nInserted', 0)} products; {len(details.get('writeErrors', []))} failed.")
+                for err in details.get('writeErrors', []):
+                    st.error(f"{SAMPLE_PRODUCTS[err['index']]['sku']}: {err.get('errmsg')}")
+            bump_coll_version(DB_NAME, COLL_NAME)
 
 # ----------------------------
 # Replaced: View inventory block
@@ -160,52 +390,25 @@ elif action == "View inventory":
         low_stock_thresh = st.number_input("Low stock threshold", min_value=0, value=30)
 
     # Local helpers
-    def raw_docs_to_df(docs):
-        """Convert raw mongo docs list to DataFrame and coerce top-level types."""
-        if not docs:
-            return pd.DataFrame()
-        clean = []
-        for d in docs:
-            doc = d.copy()
-            if '_id' in doc:
-                doc['id'] = str(doc['_id'])
-                doc.pop('_id', None)
-            clean.append(doc)
-        df = pd.DataFrame(clean)
-        return df
-
-    def clean_and_transform(df):
-        """Perform cleaning and add useful columns."""
-        if df.empty:
-            return df
-        if 'quantity' in df.columns:
-            df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce').fillna(0).astype(int)
-        else:
-            df['quantity'] = 0
-        if 'price' in df.columns:
-            df['price'] = pd.to_numeric(df['price'], errors='coerce').fillna(0.0).astype(float)
-        else:
-            df['price'] = 0.0
-
-        if 'last_restock' in df.columns:
-            df['last_restock'] = pd.to_datetime(df['last_restock'], errors='coerce')
-        else:
-            df['last_restock'] = pd.NaT
-
-        df['name'] = df.get('name', pd.Series()).fillna('Unknown')
-        df['sku'] = df.get('sku', pd.Series()).fillna('')
-
-        df['value'] = df['quantity'] * df['price']
-        today = pd.Timestamp(datetime.today().date())
-        df['days_since_restock'] = (today - df['last_restock']).dt.days
-        df['days_since_restock'] = df['days_since_restock'].fillna(-1).astype(int)
-        return df
-
-    def dataframe_to_csv_bytes_local(df, include_bom=True):
-        if df.empty:
+    def table_to_csv_bytes_local(table, include_bom=True):
+        if table.num_rows == 0:
             return "".encode('utf-8')
-        csv = df.to_csv(index=False)
-        return csv.encode('utf-8-sig') if include_bom else csv.encode('utf-8')
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(table, sink)
+        buf = sink.getvalue()
+        return (b"\xef\xbb\xbf" + buf.to_pybytes()) if include_bom else buf.to_pybytes()
+
+    def write_full_export_csv(sink, batch_size=2000):
+        """Stream the whole collection into a CSV sink one cleaned batch at a time."""
+        # Exhaust cursors let the server push batches without getMore round trips,
+        # but mongos rejects them, so sharded deployments keep the default cursor.
+        cursor_type = CursorType.NON_TAILABLE if client.is_mongos else CursorType.EXHAUST
+        # Close the cursor even if the export fails part way: an exhaust cursor
+        # pins its connection until it is drained or closed.
+        with coll.find({}, _PROJ, cursor_type=cursor_type, batch_size=batch_size) as cursor, \
+                pacsv.CSVWriter(sink, CLEAN_SCHEMA) as writer:
+            for batch in _batches(cursor, batch_size):
+                writer.write_table(clean_and_transform(raw_docs_to_table(batch)))
 
     # Export / analysis controls
     st.markdown("**Export & Analysis Controls**")
@@ -217,26 +420,20 @@ elif action == "View inventory":
     with c3:
         save_server = st.button("Save full CSV on server (exports/inventory_export.csv)")
 
-    # Build query and fetch
-    q = {}
-    if search:
-        q = {"$or": [{"name": {"$regex": search, "$options": "i"}},
-                     {"sku": {"$regex": search, "$options": "i"}},
-                     {"category": {"$regex": search, "$options": "i"}}]}
-    raw_products = list(coll.find(q).limit(2000))
-    df_raw = raw_docs_to_df(raw_products)
+    # Fetch (cached until the next write or ttl expiry)
+    version = coll_version(DB_NAME, COLL_NAME)
+    table = _cleaned_inventory(DB_NAME, COLL_NAME, search, text_search, version)
 
-    if df_raw.empty:
+    if table.num_rows == 0:
         st.info("No products found.")
     else:
-        df = clean_and_transform(df_raw)
-
-        display_cols = [c for c in ['sku','name','category','quantity','price','value','supplier','last_restock','days_since_restock','id'] if c in df.columns]
-        st.dataframe(df[display_cols])
+        display_cols = [c for c in ['sku','name','category','quantity','price','value','supplier','last_restock','days_since_restock','id'] if c in table.column_names]
+        view = table.select(display_cols)
+        st.dataframe(view)
 
         # Export filtered view
         if prepare_filtered:
-            csv_bytes = dataframe_to_csv_bytes_local(df[display_cols])
+            csv_bytes = table_to_csv_bytes_local(view)
             st.download_button(
                 label="⬇️ Download CURRENT view as CSV",
                 data=csv_bytes,
@@ -246,9 +443,10 @@ elif action == "View inventory":
 
         # Immediate download full CSV
         if download_all_now:
-            all_docs = list(coll.find({}))
-            df_all = clean_and_transform(raw_docs_to_df(all_docs))
-            csv_bytes = dataframe_to_csv_bytes_local(df_all)
+            sink = pa.BufferOutputStream()
+            sink.write(b"\xef\xbb\xbf")
+            write_full_export_csv(sink)
+            csv_bytes = sink.getvalue().to_pybytes()
             st.download_button(
                 label="⬇️ Download FULL inventory CSV",
                 data=csv_bytes,
@@ -258,20 +456,18 @@ elif action == "View inventory":
 
         # Save server copy
         if save_server:
-            all_docs = list(coll.find({}))
-            df_all = clean_and_transform(raw_docs_to_df(all_docs))
             try:
                 os.makedirs("exports", exist_ok=True)
-                df_all.to_csv("exports/inventory_export.csv", index=False, encoding='utf-8')
+                write_full_export_csv("exports/inventory_export.csv")
                 st.success("Saved exports/inventory_export.csv on server")
             except Exception as e:
                 st.error(f"Failed to save CSV on server: {e}")
 
         # Summary metrics
         st.subheader("Summary metrics")
-        total_products = len(df)
-        total_quantity = int(df['quantity'].sum()) if 'quantity' in df.columns else 0
-        total_value = float(df['value'].sum()) if 'value' in df.columns else 0.0
+        total_products = table.num_rows
+        total_quantity = int(pc.sum(table['quantity']).as_py() or 0)
+        total_value = float(pc.sum(table['value']).as_py() or 0.0)
         col_a, col_b, col_c = st.columns(3)
         col_a.metric("Products shown", total_products)
         col_b.metric("Total quantity", f"{total_quantity:,}")
@@ -280,54 +476,49 @@ elif action == "View inventory":
         # Visualizations
         st.subheader("Visualizations")
 
+        # Category / top-10 / restock / low-stock charts are aggregated server-side
+        aggs = _fetch_aggregates(DB_NAME, COLL_NAME, search, text_search, int(low_stock_thresh), version)
+
         # Category aggregates
-        if 'category' in df.columns:
-            cat_agg = df.groupby('category').agg(total_qty=('quantity','sum'), total_value=('value','sum')).reset_index()
+        if aggs["category"]:
+            cat_agg = pa.Table.from_pylist(aggs["category"])
             st.markdown("**Total quantity by category**")
-            st.bar_chart(cat_agg.set_index('category')['total_qty'])
+            st.bar_chart(cat_agg, x='category', y='total_qty')
             st.markdown("**Total value by category**")
-            st.bar_chart(cat_agg.set_index('category')['total_value'])
+            st.bar_chart(cat_agg, x='category', y='total_value')
 
         # Top 10 by value
-        if 'value' in df.columns and 'name' in df.columns:
+        if aggs["top_value"]:
             st.markdown("**Top 10 products by inventory value**")
-            top_by_value = df.sort_values('value', ascending=False).head(10).set_index('name')[['value']]
-            st.bar_chart(top_by_value)
+            st.bar_chart(pa.Table.from_pylist(aggs["top_value"]), x='name', y='value')
 
         # Price distribution
-        if 'price' in df.columns:
+        if 'price' in table.column_names:
             st.markdown("**Price distribution**")
-            price_hist = df['price'].dropna()
-            hist = pd.cut(price_hist, bins=10).value_counts().sort_index()
-            st.bar_chart(hist)
+            st.bar_chart(_price_histogram(DB_NAME, COLL_NAME, search, text_search, version))
 
         # Quantity vs Price scatter
-        if {'quantity','price'}.issubset(df.columns):
+        if {'quantity','price'}.issubset(table.column_names):
             st.markdown("**Quantity vs Price (scatter)**")
-            fig, ax = plt.subplots()
-            ax.scatter(df['price'], df['quantity'], alpha=0.7)
+            from matplotlib.figure import Figure  # deferred: only this chart needs matplotlib
+            fig = Figure()
+            ax = fig.subplots()
+            ax.scatter(table['price'].to_numpy(), table['quantity'].to_numpy(), alpha=0.7)
             ax.set_xlabel('Price')
             ax.set_ylabel('Quantity')
             ax.set_title('Quantity vs Price')
             st.pyplot(fig)
 
         # Restock timeline
-        if 'last_restock' in df.columns and not df['last_restock'].isna().all():
+        if aggs["restock_monthly"]:
             st.markdown("**Restock timeline (monthly)**")
-            df_rest = df.dropna(subset=['last_restock']).copy()
-            df_rest['restock_month'] = df_rest['last_restock'].dt.to_period('M').dt.to_timestamp()
-            restock_monthly = df_rest.groupby('restock_month').agg(total_qty=('quantity','sum')).reset_index().set_index('restock_month')
-            if not restock_monthly.empty:
-                st.line_chart(restock_monthly['total_qty'])
-            else:
-                st.info("No restock dates available for timeline.")
+            st.line_chart(pa.Table.from_pylist(aggs["restock_monthly"]), x='restock_month', y='total_qty')
 
         # Low stock table
-        if 'quantity' in df.columns:
-            low = df[df['quantity'] <= low_stock_thresh].sort_values('quantity').head(20)
-            st.markdown(f"**Low stock items (<= {low_stock_thresh}) — {len(low)}**")
-            if not low.empty:
-                st.table(low[['sku','name','quantity','supplier','days_since_restock']])
+        low = aggs["low_stock"]
+        st.markdown(f"**Low stock items (<= {low_stock_thresh}) — {len(low)}**")
+        if low:
+            st.table(pa.Table.from_pylist(low, schema=_LOW_STOCK_SCHEMA))
 
 # ----------------------------
 # Add product
@@ -351,10 +542,11 @@ elif action == "Add product":
             'quantity': int(quantity),
             'price': float(price),
             'supplier': supplier,
-            'last_restock': last_restock.isoformat()
+            'last_restock': datetime.combine(last_restock, datetime.min.time())
         }
         try:
             res = coll.insert_one(doc)
+            bump_coll_version(DB_NAME, COLL_NAME)
             st.success(f"Inserted product with id {res.inserted_id}")
         except Exception as e:
             st.error(f"Insert failed: {e}")
@@ -363,6 +555,7 @@ elif action == "Add product":
 # Update product
 # ----------------------------
 elif action == "Update product":
+    from bson.objectid import ObjectId
     st.header("Update product")
     prod_id = st.text_input("Paste product id to update (use View inventory to copy 'id' column)")
     if st.button("Load product") and prod_id:
@@ -392,10 +585,11 @@ elif action == "Update product":
                     value = float(new_val)
                 if field == 'last_restock':
                     try:
-                        value = datetime.fromisoformat(new_val).date().isoformat()
+                        value = datetime.combine(datetime.fromisoformat(new_val).date(), datetime.min.time())
                     except:
                         pass
                 res = coll.update_one({'_id': ObjectId(prod_id)}, {'$set': {field: value}})
+                bump_coll_version(DB_NAME, COLL_NAME)
                 st.success(f"Matched {res.matched_count}, modified {res.modified_count}")
             except Exception as e:
                 st.error(f"Update failed: {e}")
@@ -404,11 +598,13 @@ elif action == "Update product":
 # Delete product
 # ----------------------------
 elif action == "Delete product":
+    from bson.objectid import ObjectId
     st.header("Delete product")
     del_id = st.text_input('Product id to delete')
     if st.button('Delete') and del_id:
         try:
             res = coll.delete_one({'_id': ObjectId(del_id)})
+            bump_coll_version(DB_NAME, COLL_NAME)
             st.success(f"Deleted {res.deleted_count} product(s)")
         except Exception as e:
             st.error(f"Delete failed: {e}")